@@ -9,10 +9,21 @@ import platform
 import re
 import datetime
 import shlex
+import hashlib
+import difflib
+import tempfile
+import time
 import distro
 import warnings
 from typing import Optional, Dict, Any, List, Tuple
 
+# fcntl is only available on POSIX systems; manifest locking is skipped elsewhere
+try:
+    import fcntl
+    HAVE_FCNTL = True
+except ImportError:
+    HAVE_FCNTL = False
+
 # Version information
 VERSION = "1.1.0"
 MIN_REQUIRED_GENAI_VERSION = "0.8.5"
@@ -47,6 +58,75 @@ CRITICAL_COMMANDS = [
     'shutdown', 'reboot', 'init', 'systemctl'
 ]
 
+# Read-only commands whose output may be memoized (opt-in via command_cache_enabled).
+# Multi-word entries match as a prefix, e.g. 'systemctl status' matches 'systemctl status nginx'.
+READ_ONLY_COMMANDS = [
+    'df', 'du', 'free', 'uptime', 'uname', 'lsblk', 'lscpu', 'lsusb', 'lspci',
+    'ls', 'cat', 'whoami', 'id', 'ps', 'printenv', 'which', 'nproc',
+    'ip addr', 'ip a', 'ip route', 'ip r', 'ip link show', 'ss', 'netstat',
+    'systemctl status', 'systemctl is-active', 'systemctl is-enabled', 'systemctl list-units',
+    'journalctl', 'dpkg -l', 'rpm -qa', 'pip list', 'git status', 'docker ps',
+    'grep', 'head', 'tail', 'wc',
+]
+
+# Arguments that turn an otherwise read-only command into a state-changing one
+STATE_CHANGING_ARGS = [
+    'add', 'append', 'del', 'delete', 'set', 'flush', 'change', 'replace',
+    '--rotate', '--vacuum-size', '--vacuum-time', '--vacuum-files',
+    '-delete', '-exec', '-execdir', '-ok', '-okdir', '-fprint', '-fprintf', '-fls',
+    '-K', '--kill',
+    '--flush', '--sync', '--relinquish-var', '--smart-relinquish-var', '--setup-keys', '--update-catalog',
+]
+
+# Commands whose options mix queries with actions only count as read-only when every
+# option is one of these query options (values such as '-n 50' or '_PID=1' are fine)
+READ_ONLY_OPTIONS = {
+    'journalctl': [
+        '-u', '--unit', '--user-unit', '-b', '--boot', '-k', '--dmesg', '-n', '--lines',
+        '-p', '--priority', '-S', '--since', '-U', '--until', '-g', '--grep', '--case-sensitive',
+        '-t', '--identifier', '-x', '--catalog', '-e', '--pager-end', '-r', '--reverse',
+        '-o', '--output', '--output-fields', '-a', '--all', '-l', '--full', '-q', '--quiet',
+        '-m', '--merge', '-D', '--directory', '--file', '--system', '--user', '--no-pager',
+        '--no-hostname', '--utc', '--list-boots', '--disk-usage', '--no-tail', '--facility',
+    ],
+}
+
+# Chat questions describing a performance symptom get a live system snapshot added to the prompt.
+# Plain how-to questions ("how do I check disk space?") deliberately do not match.
+DIAGNOSTIC_PATTERN = re.compile(
+    r'\b(slow(ly|er|ness|s)?|sluggish|lag(s|gy|ging)?|hang(s|ing)?|hung|freez\w*|frozen|stuck|'
+    r'unresponsive|thrash\w*|swapping|oom|out of (memory|space)|no space left|running out|'
+    r'(high|heavy|spik\w*) (load|cpu|memory|ram|io|i/o|disk)|(load|cpu|memory|ram|disk) (is )?(spik\w*|maxed|pegged|full)|'
+    r'100 ?%)(?!\w)',
+    re.IGNORECASE
+)
+
+# Shell syntax that may write files or chain arbitrary commands
+SHELL_WRITE_PATTERN = re.compile(r'>|;|&|`|\$\(|<\(|\n')
+
+# Approximate characters per word-like token used for local token estimates.
+# Gemini does not publish per-model ratios, so one ratio is used; 'chars_per_token' in the config overrides it.
+DEFAULT_CHARS_PER_TOKEN = 4.0
+
+# Maximum estimated prompt tokens per prompt type ('prompt_token_budgets' in the config overrides these)
+DEFAULT_PROMPT_TOKEN_BUDGETS = {
+    'explain': 2000,
+    'install': 2000,
+    'auto_install': 2000,
+    'script': 2000,
+    'errorlog': 8000,
+    'fix': 4000,
+    'chat': 4000,
+}
+
+# Input tokens always kept when compacting, even if the budget is smaller than the template
+MIN_PROMPT_INPUT_TOKENS = 64
+
+# System info fields kept when a prompt has to be compacted
+ESSENTIAL_SYSTEM_FIELDS = [
+    'os', 'os_release', 'arch', 'package_manager', 'distribution', 'distribution_version',
+]
+
 # Package managers by OS/distribution
 PACKAGE_MANAGERS = {
     # Debian-based
@@ -240,6 +320,1085 @@ class SystemDetector:
         return self.detailed_info
 
 
+class ScriptStore:
+    """Content-addressed storage for generated scripts with a searchable manifest.
+
+    Scripts are stored once per unique content under ``objects/<hh>/<sha256>.sh``
+    and ``index.json`` maps each description to the script versions saved for it.
+    """
+
+    MANIFEST_NAME = "index.json"
+    LOCK_NAME = ".index.lock"
+    OBJECTS_DIR = "objects"
+    # Near-duplicate pre-filter: minhash size, minimum estimated line-set
+    # similarity for a candidate, and how many candidates are fully diffed
+    MINHASH_SIZE = 32
+    MINHASH_PRIME = (1 << 61) - 1
+    MIN_ESTIMATED_JACCARD = 0.5
+    MAX_DIFF_CANDIDATES = 20
+    _MINHASH_PARAMS: Optional[List[Tuple[int, int]]] = None
+
+    def __init__(self, root: str, similarity_threshold: float = 0.9, match_threshold: float = 0.6):
+        """Initialize the script store rooted at the given directory."""
+        self.root = os.path.expanduser(root)
+        self.similarity_threshold = similarity_threshold
+        self.match_threshold = match_threshold
+        self.manifest_path = os.path.join(self.root, self.MANIFEST_NAME)
+        self.lock_path = os.path.join(self.root, self.LOCK_NAME)
+
+    @staticmethod
+    def _normalize_description(description: str) -> str:
+        """Normalize a description for matching (lowercase, single spaces, no punctuation)."""
+        return " ".join(re.findall(r"[a-z0-9]+", description.lower()))
+
+    @staticmethod
+    def _normalize_script(content: str) -> str:
+        """Strip comments and whitespace differences so near-duplicates compare equal."""
+        lines = []
+        for line in content.splitlines():
+            stripped = line.strip()
+            if not stripped or (stripped.startswith('#') and not stripped.startswith('#!')):
+                continue
+            lines.append(" ".join(stripped.split()))
+        return "\n".join(lines)
+
+    def _object_path(self, digest: str) -> str:
+        """Return the on-disk path for a script with the given content hash."""
+        return os.path.join(self.root, self.OBJECTS_DIR, digest[:2], f"{digest}.sh")
+
+    def _lock(self):
+        """Open and exclusively lock the manifest lock file."""
+        os.makedirs(self.root, exist_ok=True)
+        lock_file = open(self.lock_path, 'a')
+        if HAVE_FCNTL:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _load_manifest(self, repair: bool = False) -> Dict[str, Any]:
+        """Load the manifest, returning an empty one if missing or unreadable.
+
+        With ``repair``, an unreadable manifest is moved aside to
+        ``index.json.corrupt-<timestamp>`` so that writing a fresh one never
+        destroys it. Only call this while holding the manifest lock.
+        """
+        manifest = {"version": 1, "scripts": {}, "descriptions": {}}
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r') as f:
+                    manifest.update(json.load(f))
+            except (json.JSONDecodeError, IOError) as e:
+                if not repair:
+                    print(f"Warning: Couldn't load script index: {e}")
+                    return manifest
+                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+                corrupt_path = f"{self.manifest_path}.corrupt-{timestamp}"
+                os.replace(self.manifest_path, corrupt_path)
+                print(f"Warning: Couldn't load script index ({e}); moved it to {corrupt_path}")
+        return manifest
+
+    def _write_manifest(self, manifest: Dict[str, Any]) -> None:
+        """Atomically replace the manifest on disk."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".index.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                # Compact output uses the C encoder, which matters for large stores
+                f.write(json.dumps(manifest, separators=(',', ':')))
+            os.replace(tmp_path, self.manifest_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def _publish(self, digest: str, content: str) -> Tuple[str, bool]:
+        """Write script content under its hash without clobbering an existing object.
+
+        The content is written to a temporary file and hard-linked into place, so
+        the dedup check and the publish happen in a single atomic step.
+        """
+        path = self._object_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            return path, False
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-", suffix=".sh")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            os.chmod(tmp_path, 0o755)
+            try:
+                os.link(tmp_path, path)
+                created = True
+            except FileExistsError:
+                created = False
+            except OSError:
+                # Filesystems without hard links: fall back to an exclusive create
+                try:
+                    out_fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o755)
+                except FileExistsError:
+                    created = False
+                else:
+                    with os.fdopen(out_fd, 'w') as f:
+                        f.write(content)
+                    created = True
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        return path, created
+
+    @classmethod
+    def _fingerprint(cls, normalized: str) -> Dict[str, Any]:
+        """Return the cheap similarity pre-filter stored in the index for a normalized script.
+
+        ``minhash`` holds the minimum of MINHASH_SIZE hash functions over the
+        script's lines; the fraction of equal positions between two fingerprints
+        estimates the Jaccard similarity of their line sets.
+        """
+        line_hashes = [
+            int.from_bytes(hashlib.blake2b(line.encode('utf-8'), digest_size=8).digest(), 'big')
+            for line in set(normalized.split("\n"))
+        ]
+        minhash = [min((a * h + b) % cls.MINHASH_PRIME for h in line_hashes) & 0xffffffff
+                   for a, b in cls._minhash_params()]
+        return {"normalized_length": len(normalized), "minhash": minhash}
+
+    @classmethod
+    def _minhash_params(cls) -> List[Tuple[int, int]]:
+        """Return deterministic (a, b) coefficients for the minhash functions."""
+        if cls._MINHASH_PARAMS is None:
+            params = []
+            for i in range(cls.MINHASH_SIZE):
+                seed = hashlib.sha256(f"minhash-{i}".encode('utf-8')).digest()
+                params.append((int.from_bytes(seed[:8], 'big') | 1, int.from_bytes(seed[8:16], 'big')))
+            cls._MINHASH_PARAMS = params
+        return cls._MINHASH_PARAMS
+
+    def _entry_fingerprint(self, digest: str, entry: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Return an index entry's fingerprint, computing and storing it for older entries."""
+        if "minhash" not in entry or "normalized_length" not in entry:
+            try:
+                with open(self._object_path(digest), 'r') as f:
+                    entry.update(self._fingerprint(self._normalize_script(f.read())))
+            except IOError:
+                return None
+        return entry
+
+    def _find_near_duplicates(self, manifest: Dict[str, Any], digest: str, content: str,
+                              fuzzy: bool = True) -> List[Tuple[str, float]]:
+        """Return (digest, similarity) pairs for stored scripts similar to the content.
+
+        Candidates are pre-filtered using the lengths and minhash fingerprints kept
+        in the index, and only the MAX_DIFF_CANDIDATES most promising are diffed, so
+        the cost of a save stays flat as the store grows. Without ``fuzzy`` only
+        scripts that are identical apart from comments and whitespace are reported.
+        """
+        normalized = self._normalize_script(content)
+        normalized_digest = hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+        fingerprint = self._fingerprint(normalized)
+        near = []
+        candidates = []
+        for other_digest, entry in manifest["scripts"].items():
+            if other_digest == digest:
+                continue
+            if entry.get("normalized_sha256") == normalized_digest:
+                near.append((other_digest, 1.0))
+                continue
+            if not fuzzy:
+                continue
+            other = self._entry_fingerprint(other_digest, entry)
+            if other is None:
+                continue
+            # SequenceMatcher.ratio() can never exceed this bound on lengths
+            total_length = fingerprint["normalized_length"] + other["normalized_length"]
+            if not total_length or 2.0 * min(fingerprint["normalized_length"],
+                                             other["normalized_length"]) / total_length < self.similarity_threshold:
+                continue
+            matches = sum(1 for x, y in zip(fingerprint["minhash"], other["minhash"]) if x == y)
+            estimate = matches / self.MINHASH_SIZE
+            if estimate >= self.MIN_ESTIMATED_JACCARD:
+                candidates.append((estimate, other_digest))
+
+        candidates.sort(reverse=True)
+        for _, other_digest in candidates[:self.MAX_DIFF_CANDIDATES]:
+            try:
+                with open(self._object_path(other_digest), 'r') as f:
+                    other_normalized = self._normalize_script(f.read())
+            except IOError:
+                continue
+            matcher = difflib.SequenceMatcher(None, normalized, other_normalized)
+            # Cheap upper bounds first; full ratio only for plausible candidates
+            if matcher.real_quick_ratio() < self.similarity_threshold:
+                continue
+            if matcher.quick_ratio() < self.similarity_threshold:
+                continue
+            ratio = matcher.ratio()
+            if ratio >= self.similarity_threshold:
+                near.append((other_digest, ratio))
+        near.sort(key=lambda item: item[1], reverse=True)
+        return near
+
+    def _record(self, manifest: Dict[str, Any], content: str, description: str, saved: str,
+                fuzzy: bool = True) -> Dict[str, Any]:
+        """Publish a script and record it under its description in the loaded manifest."""
+        digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        path, created = self._publish(digest, content)
+
+        entry = manifest["scripts"].get(digest)
+        if entry is None:
+            near_duplicates = self._find_near_duplicates(manifest, digest, content, fuzzy=fuzzy)
+            normalized = self._normalize_script(content)
+            entry = {
+                "path": os.path.relpath(path, self.root),
+                "normalized_sha256": hashlib.sha256(normalized.encode('utf-8')).hexdigest(),
+                "size": len(content.encode('utf-8')),
+                "created": saved,
+                "descriptions": [],
+                "near_duplicates": {d: round(ratio, 3) for d, ratio in near_duplicates},
+            }
+            entry.update(self._fingerprint(normalized))
+            manifest["scripts"][digest] = entry
+        else:
+            near_duplicates = list(entry.get("near_duplicates", {}).items())
+
+        entry["last_saved"] = max(entry.get("last_saved", ""), saved)
+        if description not in entry["descriptions"]:
+            entry["descriptions"].append(description)
+
+        versions = manifest["descriptions"].setdefault(self._normalize_description(description), [])
+        if digest not in versions:
+            versions.append(digest)
+
+        return {
+            "path": path,
+            "sha256": digest,
+            "created": created,
+            "near_duplicates": [(self._object_path(d), ratio) for d, ratio in near_duplicates],
+        }
+
+    def _import_legacy(self, manifest: Dict[str, Any]) -> None:
+        """Index timestamped scripts saved by older versions directly in the store root.
+
+        Runs once per store. The original files are left in place; their content
+        is copied into the store (deduplicated) and recorded under a description
+        derived from the file name.
+        """
+        if manifest.get("legacy_imported") or not os.path.isdir(self.root):
+            return
+
+        pattern = re.compile(r'^(.*?)_(\d{8})_(\d{6})\.sh$')
+        imported = 0
+        for name in sorted(os.listdir(self.root)):
+            match = pattern.match(name)
+            path = os.path.join(self.root, name)
+            if not match or not os.path.isfile(path):
+                continue
+            try:
+                with open(path, 'r') as f:
+                    content = f.read()
+            except (IOError, UnicodeDecodeError):
+                continue
+            description = match.group(1).replace('_', ' ').strip() or name
+            saved = datetime.datetime.strptime(match.group(2) + match.group(3), "%Y%m%d%H%M%S")
+            self._record(manifest, content, description, saved.isoformat(), fuzzy=False)
+            imported += 1
+
+        manifest["legacy_imported"] = True
+        if imported:
+            print(f"Indexed {imported} previously saved script(s) from {self.root}")
+
+    def _ensure_legacy_imported(self) -> None:
+        """Import legacy scripts into the manifest if that has not happened yet."""
+        if not os.path.isdir(self.root):
+            return
+        if os.path.exists(self.manifest_path) and self._load_manifest().get("legacy_imported"):
+            return
+
+        lock_file = self._lock()
+        try:
+            manifest = self._load_manifest(repair=True)
+            if not manifest.get("legacy_imported"):
+                self._import_legacy(manifest)
+                self._write_manifest(manifest)
+        finally:
+            lock_file.close()
+
+    def add(self, content: str, description: str) -> Dict[str, Any]:
+        """Store a script and record it under its description.
+
+        Returns a dict with the script ``path``, whether it was ``created`` or
+        already stored, and any ``near_duplicates`` as (path, similarity) pairs.
+        """
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+
+        lock_file = self._lock()
+        try:
+            manifest = self._load_manifest(repair=True)
+            self._import_legacy(manifest)
+            result = self._record(manifest, content, description, now)
+            self._write_manifest(manifest)
+        finally:
+            lock_file.close()
+        return result
+
+    def search(self, query: str, limit: int = 5) -> List[Dict[str, Any]]:
+        """Find stored scripts whose descriptions match the query, best match first."""
+        query_key = self._normalize_description(query)
+        self._ensure_legacy_imported()
+        if not query_key or not os.path.exists(self.manifest_path):
+            return []
+
+        query_words = set(query_key.split())
+        manifest = self._load_manifest()
+        results = []
+        for key, versions in manifest["descriptions"].items():
+            words = set(key.split())
+            overlap = len(query_words & words) / len(query_words | words) if words else 0.0
+            score = max(overlap, difflib.SequenceMatcher(None, query_key, key).ratio())
+            if score < self.match_threshold:
+                continue
+            # The most recently saved version of a description is offered first
+            for version, digest in enumerate(reversed(versions)):
+                entry = manifest["scripts"].get(digest)
+                if entry is None:
+                    continue
+                path = os.path.join(self.root, entry["path"])
+                if not os.path.exists(path):
+                    continue
+                results.append({
+                    "path": path,
+                    "sha256": digest,
+                    "description": next((d for d in entry["descriptions"]
+                                         if self._normalize_description(d) == key), key),
+                    "versions": len(versions),
+                    "version": len(versions) - version,
+                    "score": score,
+                    "saved": entry.get("last_saved", entry.get("created", "")),
+                })
+
+        results.sort(key=lambda r: (r["score"], r["saved"]), reverse=True)
+        seen = set()
+        unique = []
+        for result in results:
+            if result["sha256"] in seen:
+                continue
+            seen.add(result["sha256"])
+            unique.append(result)
+        return unique[:limit]
+
+
+class CommandCache:
+    """Short-lived memoization of read-only command output.
+
+    Entries are keyed by working directory and command line, expire after a
+    per-command TTL, and are all dropped whenever a state-changing command runs.
+    """
+
+    def __init__(self, allowlist: List[str], default_ttl: float = 30, ttls: Optional[Dict[str, float]] = None):
+        """Initialize the cache with the read-only allowlist and TTL settings."""
+        self.allowlist = [entry.split() for entry in allowlist]
+        self.default_ttl = default_ttl
+        self.ttls = ttls or {}
+        self.entries: Dict[Tuple[str, str], Tuple[float, float, int, str]] = {}
+
+    @staticmethod
+    def _changes_state(arg: str) -> bool:
+        """Return True if a command argument may make the command change state."""
+        # '--vacuum-size=100M' is the same option as '--vacuum-size 100M'
+        if arg.split('=', 1)[0] in STATE_CHANGING_ARGS:
+            return True
+        # Clustered short options, e.g. 'ss -tK'
+        if re.match(r'^-[A-Za-z]{2,}$', arg):
+            return any(f"-{flag}" in STATE_CHANGING_ARGS for flag in arg[1:])
+        return False
+
+    def _match_allowlist(self, stage: str) -> Optional[str]:
+        """Return the allowlist entry matching a single pipeline stage, if any."""
+        try:
+            parts = shlex.split(stage)
+        except ValueError:
+            return None
+        if not parts or any(self._changes_state(arg) for arg in parts[1:]):
+            return None
+
+        # Prefer the longest (most specific) entry so per-entry TTLs apply
+        best = None
+        for entry in self.allowlist:
+            if parts[:len(entry)] == entry and (best is None or len(entry) > len(best)):
+                best = entry
+        if best is None:
+            return None
+
+        entry = " ".join(best)
+        allowed = READ_ONLY_OPTIONS.get(entry)
+        if allowed is not None and not all(self._is_query_option(arg, allowed) for arg in parts[len(best):]):
+            return None
+        return entry
+
+    @staticmethod
+    def _is_query_option(arg: str, allowed: List[str]) -> bool:
+        """Return True if an argument is a value or one of the allowed query options."""
+        if not arg.startswith('-') or arg == '-':
+            return True
+        if arg.startswith('--'):
+            return arg.split('=', 1)[0] in allowed
+        if arg[:2] not in allowed:
+            return False
+        # '-xe' clusters flags; '-n50' attaches a value to the first flag
+        rest = arg[2:]
+        return not rest.isalpha() or all(f"-{flag}" in allowed for flag in rest)
+
+    def read_only_entry(self, command: str) -> Optional[str]:
+        """Return the allowlist entry for a read-only command, or None if it may change state."""
+        if SHELL_WRITE_PATTERN.search(command):
+            return None
+
+        stages = command.split('|')
+        entries = [self._match_allowlist(stage) for stage in stages]
+        if not all(entries):
+            return None
+        return entries[0]
+
+    def get(self, command: str) -> Optional[Tuple[int, str, float]]:
+        """Return (return code, output, age in seconds) for a fresh cached result."""
+        key = (os.getcwd(), command.strip())
+        cached = self.entries.get(key)
+        if cached is None:
+            return None
+
+        cached_at, ttl, return_code, output = cached
+        age = time.monotonic() - cached_at
+        if age >= ttl:
+            del self.entries[key]
+            return None
+        return return_code, output, age
+
+    def put(self, command: str, entry: str, return_code: int, output: str) -> None:
+        """Cache the result of a read-only command."""
+        ttl = self.ttls.get(entry, self.default_ttl)
+        if ttl <= 0:
+            return
+        self.entries[(os.getcwd(), command.strip())] = (time.monotonic(), ttl, return_code, output)
+
+    def invalidate(self) -> None:
+        """Drop every cached result."""
+        self.entries.clear()
+
+
+class TokenEstimator:
+    """Estimates prompt token counts locally, without calling the API.
+
+    Word-like runs are counted at a characters-per-token ratio and every
+    punctuation character as one token, which tracks real tokenizers closely
+    enough for budgeting logs, JSON and shell commands.
+    """
+
+    TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+    # Tokens reserved for the omission marker inserted by truncate_middle
+    MARKER_TOKENS = 24
+
+    def __init__(self, chars_per_token: float = DEFAULT_CHARS_PER_TOKEN):
+        """Initialize the estimator with the characters-per-token ratio."""
+        self.chars_per_token = chars_per_token
+
+    def count(self, text: str) -> int:
+        """Return the estimated number of tokens in the text."""
+        tokens = 0
+        for match in self.TOKEN_PATTERN.finditer(text):
+            length = match.end() - match.start()
+            tokens += max(1, -(-length // self.chars_per_token))
+        return int(tokens)
+
+    def clip(self, text: str, max_tokens: int, from_end: bool = False) -> str:
+        """Return the longest prefix (or suffix) of the text within max_tokens."""
+        if max_tokens <= 0:
+            return ""
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            piece = text[len(text) - mid:] if from_end else text[:mid]
+            if self.count(piece) <= max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+        return text[len(text) - low:] if from_end else text[:low]
+
+    def _take_lines(self, lines: List[str], max_tokens: int, from_end: bool) -> Tuple[List[str], int, int, int]:
+        """Take whole lines from the start (or end) within max_tokens, clipping the first one that doesn't fit.
+
+        Returns (lines taken, tokens used, whole lines consumed, characters taken from a clipped line).
+        """
+        taken = []
+        used = 0
+        clipped = 0
+        for line in (reversed(lines) if from_end else lines):
+            cost = self.count(line)
+            if used + cost <= max_tokens:
+                taken.append(line)
+                used += cost
+                continue
+            # Clip an oversized line rather than stopping before it, so one long
+            # line can't push everything else on this side out of the prompt
+            piece = self.clip(line, max_tokens - used, from_end)
+            if piece:
+                taken.append(piece)
+                used += self.count(piece)
+                clipped = len(piece)
+            break
+        if from_end:
+            taken.reverse()
+        return taken, used, len(taken) - (1 if clipped else 0), clipped
+
+    def truncate_middle(self, text: str, max_tokens: int) -> str:
+        """Shorten text to at most max_tokens by removing its middle and leaving a marker.
+
+        Half of the budget goes to the start of the text and the rest to the end.
+        """
+        total = self.count(text)
+        if total <= max_tokens:
+            return text
+        budget = max_tokens - self.MARKER_TOKENS
+        if budget <= 0:
+            return ""
+
+        lines = text.split("\n")
+        head, head_used, consumed, clipped = self._take_lines(lines, budget // 2, from_end=False)
+        rest = lines[consumed:]
+        if clipped:
+            rest[0] = rest[0][clipped:]
+        tail, tail_used, tail_consumed, tail_clipped = self._take_lines(rest, budget - head_used, from_end=True)
+
+        omitted_lines = len(rest) - tail_consumed
+        omitted_tokens = total - head_used - tail_used
+        marker = f"... [{omitted_lines} lines, ~{omitted_tokens} tokens omitted] ..."
+        return "\n".join(head + [marker] + tail)
+
+
+class SystemSampler:
+    """Samples live load, memory, pressure, disk and process data from /proc.
+
+    Everything is read directly from /proc (no subprocesses), and the result
+    is condensed into a short text summary suitable for adding to a prompt.
+    """
+
+    PROC = "/proc"
+    # Block devices that only add noise to a summary
+    IGNORED_DISK_PATTERN = re.compile(r'^(loop|ram|zram|fd|sr)\d*')
+
+    def __init__(self, samples: int = 3, interval: float = 0.2, max_tokens: int = 300, top_processes: int = 5,
+                 token_estimator: Optional[TokenEstimator] = None):
+        """Initialize the sampler with sample count, interval (seconds) and summary size limit."""
+        self.token_estimator = token_estimator or TokenEstimator()
+        self.samples = max(2, samples)
+        self.interval = interval
+        self.max_tokens = max_tokens
+        self.top_processes = top_processes
+        self.clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+        self.page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+        # Measurements from the most recent snapshot
+        self.last_stats: Dict[str, float] = {}
+
+    def is_available(self) -> bool:
+        """Return True if /proc can be sampled on this system."""
+        return os.path.exists(os.path.join(self.PROC, "loadavg"))
+
+    def _read(self, name: str) -> str:
+        """Read a /proc file, returning an empty string if it is unavailable."""
+        try:
+            with open(os.path.join(self.PROC, name), 'r') as f:
+                return f.read()
+        except (IOError, OSError):
+            return ""
+
+    def _read_meminfo(self) -> Dict[str, int]:
+        """Return /proc/meminfo values in kB."""
+        meminfo = {}
+        for line in self._read("meminfo").splitlines():
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                meminfo[parts[0].rstrip(':')] = int(parts[1])
+        return meminfo
+
+    def _read_pressure(self) -> Dict[str, float]:
+        """Return the 10s 'some' pressure stall averages for cpu, memory and io."""
+        pressure = {}
+        for resource in ("cpu", "memory", "io"):
+            match = re.search(r'^some avg10=([\d.]+)', self._read(f"pressure/{resource}"), re.MULTILINE)
+            if match:
+                pressure[resource] = float(match.group(1))
+        return pressure
+
+    def _read_cpu_times(self) -> Tuple[int, int]:
+        """Return (busy, total) jiffies from the aggregate cpu line of /proc/stat."""
+        for line in self._read("stat").splitlines():
+            if line.startswith("cpu "):
+                values = [int(v) for v in line.split()[1:]]
+                idle = values[3] + (values[4] if len(values) > 4 else 0)
+                return sum(values) - idle, sum(values)
+        return 0, 0
+
+    def _read_diskstats(self) -> Dict[str, Tuple[int, int, int]]:
+        """Return (sectors read, sectors written, io ms) per block device."""
+        disks = {}
+        for line in self._read("diskstats").splitlines():
+            parts = line.split()
+            if len(parts) < 13 or self.IGNORED_DISK_PATTERN.match(parts[2]):
+                continue
+            disks[parts[2]] = (int(parts[5]), int(parts[9]), int(parts[12]))
+        return disks
+
+    def _read_processes(self) -> Dict[int, Tuple[str, int, int]]:
+        """Return (name, cpu jiffies, rss bytes) for every process."""
+        processes = {}
+        for entry in os.listdir(self.PROC):
+            if not entry.isdigit():
+                continue
+            stat = self._read(f"{entry}/stat")
+            # The command name is parenthesised and may itself contain spaces
+            end = stat.rfind(')')
+            if end == -1:
+                continue
+            name = stat[stat.find('(') + 1:end]
+            fields = stat[end + 2:].split()
+            if len(fields) < 22:
+                continue
+            cpu = int(fields[11]) + int(fields[12])
+            rss = int(fields[21]) * self.page_size
+            processes[int(entry)] = (name, cpu, rss)
+        return processes
+
+    def _collect(self, processes: bool) -> Dict[str, Any]:
+        """Take one raw sample of the counters that are compared across samples.
+
+        Scanning every /proc/[pid] is the expensive part, so callers only ask for
+        it on the first and last sample; the cheap system-wide counters are read
+        every time so intermediate samples can show peaks.
+        """
+        return {
+            "time": time.monotonic(),
+            "cpu": self._read_cpu_times(),
+            "disks": self._read_diskstats(),
+            "processes": self._read_processes() if processes else {},
+        }
+
+    @staticmethod
+    def _cpu_busy(before: Dict[str, Any], after: Dict[str, Any]) -> float:
+        """Return the CPU busy percentage between two samples."""
+        busy = after["cpu"][0] - before["cpu"][0]
+        total = after["cpu"][1] - before["cpu"][1]
+        return 100.0 * busy / total if total else 0.0
+
+    @staticmethod
+    def _disk_util(name: str, before: Dict[str, Any], after: Dict[str, Any]) -> float:
+        """Return a disk's utilisation percentage between two samples."""
+        if name not in before["disks"] or name not in after["disks"]:
+            return 0.0
+        elapsed = max(after["time"] - before["time"], 1e-6)
+        return min(100.0, (after["disks"][name][2] - before["disks"][name][2]) / (elapsed * 10))
+
+    def _format_summary(self, samples: List[Dict[str, Any]]) -> List[str]:
+        """Turn the samples into summary lines, most important first.
+
+        Averages compare the first and last samples; peaks take the busiest
+        interval between consecutive samples.
+        """
+        lines = []
+        first, last = samples[0], samples[-1]
+        intervals = list(zip(samples, samples[1:]))
+        elapsed = max(last["time"] - first["time"], 1e-6)
+
+        loadavg = self._read("loadavg").split()
+        cpu_count = os.cpu_count() or 1
+        cpu_pct = self._cpu_busy(first, last)
+        cpu_peak = max(self._cpu_busy(a, b) for a, b in intervals)
+        if loadavg:
+            lines.append(f"load: {' '.join(loadavg[:3])} ({cpu_count} cpus), "
+                         f"cpu busy {cpu_pct:.0f}% (peak {cpu_peak:.0f}%), tasks {loadavg[3]}")
+
+        meminfo = self._read_meminfo()
+        if meminfo.get("MemTotal"):
+            mem_total = meminfo["MemTotal"] / 1048576
+            mem_avail = meminfo.get("MemAvailable", meminfo.get("MemFree", 0)) / 1048576
+            swap_used = (meminfo.get("SwapTotal", 0) - meminfo.get("SwapFree", 0)) / 1048576
+            lines.append(f"memory: {mem_avail:.1f}G available of {mem_total:.1f}G, "
+                         f"swap used {swap_used:.1f}G of {meminfo.get('SwapTotal', 0) / 1048576:.1f}G")
+
+        pressure = self._read_pressure()
+        if pressure:
+            lines.append("pressure (some avg10): " + ", ".join(f"{k} {v:.1f}%" for k, v in pressure.items()))
+
+        disk_parts = []
+        for name, (read, written, io_ms) in last["disks"].items():
+            if name not in first["disks"]:
+                continue
+            prev_read, prev_written, prev_io_ms = first["disks"][name]
+            read_mb = (read - prev_read) * 512 / 1048576 / elapsed
+            write_mb = (written - prev_written) * 512 / 1048576 / elapsed
+            util = min(100.0, (io_ms - prev_io_ms) / (elapsed * 10))
+            util_peak = max(self._disk_util(name, a, b) for a, b in intervals)
+            if read_mb or write_mb or util:
+                disk_parts.append(f"{name} r {read_mb:.1f}MB/s w {write_mb:.1f}MB/s "
+                                  f"util {util:.0f}% (peak {util_peak:.0f}%)")
+        lines.append("disk io: " + ("; ".join(disk_parts) if disk_parts else "idle"))
+
+        disk_usage = []
+        seen_devices = set()
+        for mount in ("/", "/home", "/var", "/tmp"):
+            try:
+                device = os.stat(mount).st_dev
+                st = os.statvfs(mount)
+            except OSError:
+                continue
+            # Directories on the same filesystem would only repeat the same numbers
+            if device in seen_devices or not st.f_blocks:
+                continue
+            seen_devices.add(device)
+            used_pct = 100.0 * (st.f_blocks - st.f_bfree) / st.f_blocks
+            free_gb = st.f_bavail * st.f_frsize / 1073741824
+            disk_usage.append(f"{mount} {used_pct:.0f}% used ({free_gb:.1f}G free)")
+        if disk_usage:
+            lines.append("disk space: " + ", ".join(disk_usage))
+
+        ticks = self.clock_ticks * elapsed
+        procs = []
+        for pid, (name, cpu, rss) in last["processes"].items():
+            prev = first["processes"].get(pid)
+            cpu_pct = 100.0 * (cpu - prev[1]) / ticks if prev else 0.0
+            procs.append((cpu_pct, rss, pid, name))
+        by_cpu = sorted(procs, reverse=True)[:self.top_processes]
+        by_rss = sorted(procs, key=lambda p: p[1], reverse=True)[:self.top_processes]
+        lines.append("top cpu: " + ", ".join(f"{name}[{pid}] {cpu:.0f}%" for cpu, _, pid, name in by_cpu))
+        lines.append("top rss: " + ", ".join(f"{name}[{pid}] {rss / 1048576:.0f}M" for _, rss, pid, name in by_rss))
+        return lines
+
+    def snapshot(self) -> str:
+        """Sample the system and return a compact summary bounded by max_tokens."""
+        if not self.is_available():
+            return ""
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        samples = [self._collect(processes=True)]
+        for i in range(1, self.samples):
+            time.sleep(self.interval)
+            samples.append(self._collect(processes=(i == self.samples - 1)))
+        lines = self._format_summary(samples)
+
+        # Keep whole lines, most important first, within the token budget
+        summary_lines = []
+        tokens = 0
+        for line in lines:
+            line_tokens = self.token_estimator.count(line)
+            if tokens + line_tokens > self.max_tokens:
+                break
+            summary_lines.append(line)
+            tokens += line_tokens
+        summary = "\n".join(summary_lines)
+
+        self.last_stats = {
+            "wall_ms": (time.perf_counter() - wall_start) * 1000,
+            "cpu_ms": (time.process_time() - cpu_start) * 1000,
+            "chars": len(summary),
+            "approx_tokens": tokens,
+        }
+        return summary
+
+
+class FileChangeNotifier:
+    """Waits for changes in watched directories using inotify, or by polling.
+
+    inotify is accessed through libc with ctypes so no extra dependency is
+    needed; on systems without it, wait() simply sleeps for the timeout.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, directories: List[str]):
+        """Set up inotify watches on the given directories if possible."""
+        self.fd = -1
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | self.IN_CLOEXEC)
+            if fd < 0:
+                return
+            mask = (self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM |
+                    self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE)
+            for directory in set(directories):
+                if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+                    os.close(fd)
+                    return
+            self.fd = fd
+        except (OSError, AttributeError):
+            self.fd = -1
+
+    @property
+    def using_inotify(self) -> bool:
+        """Return True if changes are detected with inotify rather than polling."""
+        return self.fd >= 0
+
+    def wait(self, timeout: float) -> None:
+        """Block until a watched directory changes or the timeout expires."""
+        if not self.using_inotify:
+            time.sleep(timeout)
+            return
+
+        import select
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            # Event details are not needed; every watched file is re-checked anyway
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self) -> None:
+        """Release the inotify file descriptor."""
+        if self.using_inotify:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class LogWatcher:
+    """Incrementally tails log files and groups new error lines into bursts.
+
+    Read positions are checkpointed by device/inode and offset so a restart
+    resumes where it stopped, and rotated or truncated files are followed.
+    Error lines are reduced to signatures so repeated errors are only analyzed once.
+    """
+
+    # Lines that look like errors worth analyzing
+    ERROR_PATTERN = re.compile(
+        r'\b(errors?|err|fail(s|ed|ures?)?|fatal|critical|crit|panics?|emerg|alerts?|exceptions?|'
+        r'traceback|segfaults?|oom|killed process|denied|timed? ?out|timeouts?)\b',
+        re.IGNORECASE
+    )
+    # Variable parts of a log line that should not affect its signature
+    SIGNATURE_SUBSTITUTIONS = [
+        (re.compile(r'^\w{3} +\d+ [\d:]+ \S+ '), ''),  # syslog timestamp and host
+        (re.compile(r'^\d{4}-\d\d-\d\d[T ][\d:.,]+\S*\s*'), ''),  # ISO timestamp
+        (re.compile(r'\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b', re.I), '<uuid>'),
+        (re.compile(r'\b0x[0-9a-f]+\b', re.I), '<hex>'),
+        (re.compile(r'\d+'), '#'),
+    ]
+    MAX_READ_BYTES = 1048576
+    MAX_SIGNATURES = 1000
+
+    def __init__(self, paths: List[str], checkpoint_path: str, debounce: float = 2.0,
+                 max_burst_seconds: float = 30.0, signature_ttl_hours: float = 24.0):
+        """Initialize the watcher for the given log files."""
+        self.paths = [os.path.abspath(os.path.expanduser(p)) for p in paths]
+        self.checkpoint_path = os.path.expanduser(checkpoint_path)
+        self.debounce = debounce
+        self.max_burst_seconds = max_burst_seconds
+        self.signature_ttl = signature_ttl_hours * 3600
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.unreadable = set()
+        self.burst: List[Tuple[str, List[str]]] = []
+        self.burst_started = 0.0
+        self.last_error_at = 0.0
+
+        checkpoint = self._load_checkpoint()
+        self.checkpoints: Dict[str, Dict[str, int]] = checkpoint.get("files", {})
+        self.signatures: Dict[str, float] = checkpoint.get("signatures", {})
+
+    def _load_checkpoint(self) -> Dict[str, Any]:
+        """Load saved offsets and analyzed signatures."""
+        if os.path.exists(self.checkpoint_path):
+            try:
+                with open(self.checkpoint_path, 'r') as f:
+                    return json.load(f)
+            except (json.JSONDecodeError, IOError) as e:
+                print(f"Warning: Couldn't load watch checkpoint: {e}")
+        return {}
+
+    def save_checkpoint(self) -> None:
+        """Atomically write current offsets and analyzed signatures to disk."""
+        files = dict(self.checkpoints)
+        for path, state in self.files.items():
+            # Bytes of an unterminated line are read again after a restart
+            offset = state["offset"] - len(state["partial"])
+            files[path] = {"dev": state["dev"], "ino": state["ino"], "offset": offset}
+
+        # Keep only the most recently analyzed signatures
+        newest = sorted(self.signatures.items(), key=lambda item: item[1], reverse=True)
+        self.signatures = dict(newest[:self.MAX_SIGNATURES])
+
+        directory = os.path.dirname(self.checkpoint_path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".watch.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({"files": files, "signatures": self.signatures}, f)
+            os.replace(tmp_path, self.checkpoint_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def _open(self, path: str, st: os.stat_result, resume: bool) -> None:
+        """Open a log file, resuming from its checkpoint or starting at the end or beginning."""
+        f = open(path, 'rb')
+        saved = self.checkpoints.get(path)
+        if resume and saved and (saved["dev"], saved["ino"]) == (st.st_dev, st.st_ino) \
+                and saved["offset"] <= st.st_size:
+            offset = saved["offset"]
+        elif resume:
+            # First time watching this file: only new lines are interesting
+            offset = st.st_size
+        else:
+            # A file that appeared after rotation is read from the start
+            offset = 0
+        f.seek(offset)
+        self.files[path] = {"file": f, "dev": st.st_dev, "ino": st.st_ino, "offset": offset, "partial": b""}
+
+    def _drain(self, state: Dict[str, Any]) -> List[str]:
+        """Read complete new lines from an open file, up to MAX_READ_BYTES."""
+        data = state["file"].read(self.MAX_READ_BYTES)
+        if not data:
+            return []
+        state["offset"] += len(data)
+        data = state["partial"] + data
+        lines = data.split(b"\n")
+        state["partial"] = lines.pop()
+        return [line.decode('utf-8', errors='replace') for line in lines]
+
+    def _drain_to_eof(self, state: Dict[str, Any]) -> List[str]:
+        """Read every complete line left in an open file, however much data remains."""
+        lines = []
+        while True:
+            offset = state["offset"]
+            lines.extend(self._drain(state))
+            if state["offset"] == offset:
+                return lines
+
+    def _read_path(self, path: str, resume: bool) -> List[str]:
+        """Return new lines from one watched path, following rotation and truncation."""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            st = None
+
+        state = self.files.get(path)
+        if state is None:
+            if st is None:
+                return []
+            self._open(path, st, resume)
+            return self._drain(self.files[path])
+
+        lines = []
+        if st is None or (st.st_dev, st.st_ino) != (state["dev"], state["ino"]):
+            # Rotated: finish the whole old file, then follow the new one from the start
+            lines.extend(self._drain_to_eof(state))
+            if st is None:
+                return lines
+            # The old file is finished, so its last unterminated line is complete
+            if state["partial"]:
+                lines.append(state["partial"].decode('utf-8', errors='replace'))
+            state["file"].close()
+            del self.files[path]
+            self._open(path, st, resume=False)
+            state = self.files[path]
+        elif st.st_size < state["offset"]:
+            # Truncated in place (copytruncate)
+            state["file"].seek(0)
+            state["offset"] = 0
+            state["partial"] = b""
+
+        lines.extend(self._drain(state))
+        return lines
+
+    def read_new_lines(self, resume: bool = False) -> List[Tuple[str, str]]:
+        """Return (path, line) pairs appended to the watched files since the last call.
+
+        A path that cannot be read (missing permission, a directory, ...) is
+        reported once and retried on later calls instead of stopping the watch.
+        """
+        new_lines = []
+        for path in self.paths:
+            try:
+                # A file that was unreadable until now resumes like one seen at startup
+                lines = self._read_path(path, resume or path in self.unreadable)
+            except OSError as e:
+                if path not in self.unreadable:
+                    print(f"Warning: Couldn't read {path}: {e}")
+                    self.unreadable.add(path)
+                continue
+            self.unreadable.discard(path)
+            new_lines.extend((path, line) for line in lines)
+        return new_lines
+
+    @classmethod
+    def signature(cls, line: str) -> str:
+        """Return a stable signature for an error line, ignoring timestamps and numbers."""
+        normalized = line.strip()
+        for pattern, replacement in cls.SIGNATURE_SUBSTITUTIONS:
+            normalized = pattern.sub(replacement, normalized)
+        return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+    def add_lines(self, lines: List[Tuple[str, str]]) -> None:
+        """Add new lines to the current burst, attaching indented continuation lines."""
+        now = time.monotonic()
+        for path, line in lines:
+            if self.ERROR_PATTERN.search(line):
+                if not self.burst:
+                    self.burst_started = now
+                self.last_error_at = now
+                self.burst.append((path, [line]))
+            elif self.burst and line[:1] in (" ", "\t") and len(self.burst[-1][1]) < 20:
+                # Tracebacks and similar multi-line errors continue with indented lines
+                self.burst[-1][1].append(line)
+
+    def time_until_flush(self) -> Optional[float]:
+        """Return seconds until the current burst should be flushed, or None if there is none."""
+        if not self.burst:
+            return None
+        now = time.monotonic()
+        return max(0.0, min(self.last_error_at + self.debounce, self.burst_started + self.max_burst_seconds) - now)
+
+    def take_burst(self) -> Tuple[str, List[str], int]:
+        """Group the finished burst by signature and return (report, new signatures, skipped lines).
+
+        The report is empty when every signature in the burst was analyzed recently.
+        """
+        groups: Dict[str, Dict[str, Any]] = {}
+        for path, lines in self.burst:
+            sig = self.signature(lines[0])
+            group = groups.setdefault(sig, {"path": path, "lines": lines, "count": 0})
+            group["count"] += 1
+        self.burst = []
+
+        now = time.time()
+        report = []
+        new_signatures = []
+        skipped = 0
+        for sig, group in groups.items():
+            if now - self.signatures.get(sig, 0) < self.signature_ttl:
+                skipped += group["count"]
+                continue
+            new_signatures.append(sig)
+            report.append(f"[{group['count']}x in {group['path']}]")
+            report.extend(group["lines"])
+        return "\n".join(report), new_signatures, skipped
+
+    def mark_analyzed(self, signatures: List[str]) -> None:
+        """Record signatures as analyzed so repeats are skipped until the TTL expires."""
+        now = time.time()
+        for sig in signatures:
+            self.signatures[sig] = now
+
+    def close(self) -> None:
+        """Close all open log files."""
+        for state in self.files.values():
+            state["file"].close()
+
+
 class TerminalAssistant:
     """Terminal assistant that helps with command-line tasks using Gemini AI."""
     
@@ -250,14 +1409,80 @@ class TerminalAssistant:
         self.system_detector = SystemDetector()
         self.system_info = self.system_detector.get_system_info()
         self.scripts_dir = self.config.get('scripts_dir', os.path.expanduser("~/scripts"))
+        self.script_store = ScriptStore(
+            self.scripts_dir,
+            similarity_threshold=self.config.get('script_similarity_threshold', 0.9),
+            match_threshold=self.config.get('script_match_threshold', 0.6),
+        )
+        # Read-only command memoization (opt-in)
+        self.command_cache = None
+        if self.config.get('command_cache_enabled', False):
+            self.command_cache = CommandCache(
+                self.config.get('command_cache_allowlist', READ_ONLY_COMMANDS),
+                default_ttl=self.config.get('command_cache_ttl', 30),
+                ttls=self.config.get('command_cache_ttls', {}),
+            )
+        # Prompt size accounting and compaction
+        self.token_estimator = TokenEstimator(self.config.get('chars_per_token', DEFAULT_CHARS_PER_TOKEN))
+        # Live /proc sampling for diagnostic prompts (chat and fix)
+        self.live_snapshot_enabled = self.config.get('live_snapshot_enabled', True)
+        self.system_sampler = SystemSampler(
+            samples=self.config.get('live_snapshot_samples', 3),
+            interval=self.config.get('live_snapshot_interval', 0.2),
+            max_tokens=self.config.get('live_snapshot_max_tokens', 300),
+            token_estimator=self.token_estimator,
+        )
+        self.prompt_token_budgets = dict(DEFAULT_PROMPT_TOKEN_BUDGETS)
+        self.prompt_token_budgets.update(self.config.get('prompt_token_budgets', {}))
+        self.usage_log_path = os.path.expanduser(
+            self.config.get('usage_log_path', "~/.terminal_assistant_usage.jsonl"))
+        self.last_call_failed = False
         # Safety settings
         self.auto_confirm_safe = self.config.get('auto_confirm_safe', False)
         self.safety_level = self.config.get('safety_level', 'high')  # high, medium, low
     
     def _generate_prompt(self, prompt_type: str, user_input: str) -> str:
-        """Generate context-aware prompt for Gemini based on the prompt type."""
+        """Generate context-aware prompt for Gemini, compacted to fit the token budget."""
         system_info = json.dumps(self.system_info, indent=2)
+        live_snapshot = self._get_live_snapshot(prompt_type, user_input)
+        prompt = self._build_prompt(prompt_type, user_input, system_info, live_snapshot)
+        
+        budget = self.prompt_token_budgets.get(prompt_type, self.prompt_token_budgets.get('chat', 4000))
+        tokens = self.token_estimator.count(prompt)
+        if tokens <= budget:
+            return prompt
         
+        # 1. Minify the system block and drop fields the model rarely needs
+        essential = {k: v for k, v in self.system_info.items() if k in ESSENTIAL_SYSTEM_FIELDS and v}
+        system_info = json.dumps(essential, separators=(',', ':'))
+        prompt = self._build_prompt(prompt_type, user_input, system_info, live_snapshot)
+        
+        # 2. Drop the live snapshot
+        if self.token_estimator.count(prompt) > budget and live_snapshot:
+            live_snapshot = ""
+            prompt = self._build_prompt(prompt_type, user_input, system_info, live_snapshot)
+        
+        # 3. Cut the middle out of the user input, shrinking it until the prompt fits.
+        # The instructions and some of the input are always kept, so a budget smaller
+        # than the template itself is raised rather than sending a prompt with no question.
+        overhead = self.token_estimator.count(prompt) - self.token_estimator.count(user_input)
+        minimum = overhead + MIN_PROMPT_INPUT_TOKENS
+        if budget < minimum:
+            print(f"Warning: {prompt_type} token budget {budget} is too small for the prompt "
+                  f"template (~{overhead} tokens); using {minimum}.")
+            budget = minimum
+        target = budget - overhead
+        while self.token_estimator.count(prompt) > budget and target > 0:
+            shortened = self.token_estimator.truncate_middle(user_input, target)
+            prompt = self._build_prompt(prompt_type, shortened, system_info, live_snapshot)
+            target -= max(1, self.token_estimator.count(prompt) - budget)
+        
+        print(f"Note: {prompt_type} prompt compacted from ~{tokens} to "
+              f"~{self.token_estimator.count(prompt)} tokens (budget {budget}).")
+        return prompt
+    
+    def _build_prompt(self, prompt_type: str, user_input: str, system_info: str, live_snapshot: str) -> str:
+        """Fill in the prompt template for the prompt type."""
         prompts = {
             "explain": f"""
 You are a helpful terminal assistant explaining a shell command.
@@ -320,7 +1545,7 @@ ERROR LOG:
             "fix": f"""
 You are a helpful terminal assistant that generates commands to fix an issue.
 Based on this system information: {system_info}
-
+{live_snapshot}
 Generate the exact commands needed to fix this problem: {user_input}
 The commands should be specifically for this system: {self.system_info['os']} {self.system_info.get('distribution', '')} {self.system_info.get('distribution_version', '')}
 The package manager is: {self.system_info['package_manager']}
@@ -331,7 +1556,7 @@ Include any necessary explanation as comments (# prefix).
             "chat": f"""
 You are a helpful terminal assistant answering system-related questions.
 Based on this system information: {system_info}
-
+{live_snapshot}
 The user asks: {user_input}
 
 Provide a helpful, accurate, and concise response focused on their terminal/system question.
@@ -341,21 +1566,83 @@ Make sure your answer is specifically tailored to this system: {self.system_info
         
         return prompts.get(prompt_type, prompts["chat"])
     
-    def _call_gemini(self, prompt: str) -> str:
+    def _get_live_snapshot(self, prompt_type: str, user_input: str) -> str:
+        """Return a live system state block for diagnostic prompts, or an empty string."""
+        if not self.live_snapshot_enabled or not self.system_sampler.is_available():
+            return ""
+        if prompt_type == "chat" and not DIAGNOSTIC_PATTERN.search(user_input):
+            return ""
+        if prompt_type not in ("chat", "fix"):
+            return ""
+
+        summary = self.system_sampler.snapshot()
+        if not summary:
+            return ""
+        return f"\nCurrent system state (live sample):\n{summary}\n"
+
+    def live_snapshot(self) -> str:
+        """Show the live system snapshot and what it costs to collect."""
+        if not self.system_sampler.is_available():
+            return "Live system snapshots require /proc (Linux only)."
+
+        summary = self.system_sampler.snapshot()
+        stats = self.system_sampler.last_stats
+        return (f"{summary}\n\n"
+                f"Sampled in {stats['wall_ms']:.0f} ms ({stats['cpu_ms']:.1f} ms CPU), "
+                f"{stats['chars']} chars (~{stats['approx_tokens']} tokens)")
+
+    def _call_gemini(self, prompt: str, prompt_type: str = "chat") -> str:
         """Call Gemini API with the given prompt."""
+        # Set until a response is received, so callers can tell errors from answers
+        self.last_call_failed = True
         if MISSING_DEPENDENCIES:
             return "Error: google-generativeai package is not installed. Please install it to use this feature."
             
         if not self.api_ready:
             return "Error: Gemini API not initialized. Please check your API key."
         
+        model_name = self.config.get('model', 'gemini-pro')
+        start = time.perf_counter()
         try:
-            model_name = self.config.get('model', 'gemini-pro')
             model = genai.GenerativeModel(model_name)
             response = model.generate_content(prompt)
-            return response.text
+            text = response.text
+            self.last_call_failed = False
         except Exception as e:
+            self._log_usage(prompt_type, model_name, prompt, "", time.perf_counter() - start, error=str(e))
             return f"Error calling Gemini API: {str(e)}"
+        
+        self._log_usage(prompt_type, model_name, prompt, text, time.perf_counter() - start,
+                        usage=getattr(response, 'usage_metadata', None))
+        return text
+    
+    def _log_usage(self, prompt_type: str, model_name: str, prompt: str, response_text: str,
+                   latency: float, usage: Any = None, error: Optional[str] = None) -> None:
+        """Append estimated and reported token counts for one API call to the usage log."""
+        if not self.usage_log_path:
+            return
+        
+        entry = {
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'prompt_type': prompt_type,
+            'model': model_name,
+            'prompt_chars': len(prompt),
+            'estimated_tokens_in': self.token_estimator.count(prompt),
+            'estimated_tokens_out': self.token_estimator.count(response_text),
+            'latency_ms': round(latency * 1000),
+        }
+        # Counts reported by the API, when the response includes them
+        if usage is not None:
+            entry['tokens_in'] = getattr(usage, 'prompt_token_count', None)
+            entry['tokens_out'] = getattr(usage, 'candidates_token_count', None)
+        if error:
+            entry['error'] = error
+        
+        try:
+            with open(self.usage_log_path, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+        except IOError:
+            pass
     
     def _is_command_critical(self, command: str) -> bool:
         """Determine if a command requires explicit user confirmation based on safety level."""
@@ -397,13 +1684,30 @@ Make sure your answer is specifically tailored to this system: {self.system_info
                 if confirmation not in ["yes", "y"]:
                     return 0, "Command execution cancelled (critical command)."
             
+            # Serve repeated read-only probes from the memo cache when enabled
+            cache_entry = None
+            if self.command_cache is not None:
+                cache_entry = self.command_cache.read_only_entry(command)
+                if cache_entry:
+                    cached = self.command_cache.get(command)
+                    if cached is not None:
+                        return_code, output, age = cached
+                        return return_code, f"[cached result from {age:.0f}s ago]\n{output}"
+                else:
+                    # Anything that may change state makes cached output stale
+                    cache_entry = None
+                    self.command_cache.invalidate()
+            
             result = subprocess.run(
                 command, 
                 shell=True, 
                 capture_output=True, 
                 text=True
             )
-            return result.returncode, result.stdout + result.stderr
+            output = result.stdout + result.stderr
+            if cache_entry:
+                self.command_cache.put(command, cache_entry, result.returncode, output)
+            return result.returncode, output
         except Exception as e:
             return 1, f"Error executing command: {str(e)}"
     
@@ -424,37 +1728,61 @@ Make sure your answer is specifically tailored to this system: {self.system_info
         
         return response.strip()
     
-    def _save_script(self, script_content: str, description: str) -> Tuple[bool, str]:
-        """Save a shell script to disk."""
-        # Create directory if it doesn't exist
-        os.makedirs(self.scripts_dir, exist_ok=True)
-        
-        # Generate filename from description
-        safe_desc = re.sub(r'[^a-zA-Z0-9_-]', '_', description.lower())
-        safe_desc = re.sub(r'_+', '_', safe_desc)  # Replace multiple underscores with one
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{safe_desc[:30]}_{timestamp}.sh"
-        filepath = os.path.join(self.scripts_dir, filename)
-        
+    def _save_script(self, script_content: str, description: str) -> Tuple[bool, str, str]:
+        """Save a shell script to the content-addressed script store.
+
+        Returns (success, path or error, note about duplicates).
+        """
         try:
-            with open(filepath, 'w') as f:
-                f.write(script_content)
-            
-            # Make the script executable
-            os.chmod(filepath, 0o755)
-            return True, filepath
+            result = self.script_store.add(script_content, description)
         except Exception as e:
-            return False, str(e)
+            return False, str(e), ""
+
+        notes = []
+        if not result["created"]:
+            notes.append("An identical script was already saved; reusing it.")
+        for path, ratio in result["near_duplicates"]:
+            notes.append(f"Near-duplicate of {path} ({ratio:.0%} similar)")
+        return True, result["path"], "\n".join(notes)
+
+    def _offer_existing_script(self, description: str) -> Optional[str]:
+        """Offer previously saved scripts matching the description; return the chosen path."""
+        matches = self.script_store.search(description)
+        if not matches:
+            return None
+
+        print("Found existing scripts matching this description:")
+        for i, match in enumerate(matches, 1):
+            print(f"{i}. {match['description']} (version {match['version']}/{match['versions']}, saved {match['saved']})")
+            print(f"   {match['path']}")
+        choice = input("Use one of these? (number/no): ").strip().lower()
+
+        if choice.isdigit() and 1 <= int(choice) <= len(matches):
+            return matches[int(choice) - 1]['path']
+        return None
+
+    def search_scripts(self, query: str) -> str:
+        """Search previously saved scripts by description."""
+        matches = self.script_store.search(query, limit=20)
+        if not matches:
+            return f"No saved scripts match: {query}"
+
+        lines = [f"Saved scripts matching '{query}':"]
+        for match in matches:
+            lines.append(f"- {match['description']} (version {match['version']}/{match['versions']}, "
+                         f"score {match['score']:.2f}, saved {match['saved']})")
+            lines.append(f"  {match['path']}")
+        return "\n".join(lines)
     
     def explain_command(self, command: str) -> str:
         """Explain what a shell command does."""
         prompt = self._generate_prompt("explain", command)
-        return self._call_gemini(prompt)
+        return self._call_gemini(prompt, "explain")
     
     def installation_guide(self, package: str) -> str:
         """Provide installation instructions for a package."""
         prompt = self._generate_prompt("install", package)
-        return self._call_gemini(prompt)
+        return self._call_gemini(prompt, "install")
     
     def auto_install(self, package: str) -> str:
         """Automatically install a package by generating and executing commands."""
@@ -478,7 +1806,7 @@ Make sure your answer is specifically tailored to this system: {self.system_info
         
         # If we get here, we're using AI to generate commands
         prompt = self._generate_prompt("auto_install", package)
-        commands_response = self._call_gemini(prompt)
+        commands_response = self._call_gemini(prompt, "auto_install")
         
         # Extract commands (one per line)
         commands = [cmd.strip() for cmd in commands_response.strip().split('\n') if cmd.strip()]
@@ -529,8 +1857,13 @@ Make sure your answer is specifically tailored to this system: {self.system_info
     
     def generate_script(self, description: str) -> str:
         """Generate a shell script from a description."""
+        # Reuse a previously saved script before asking Gemini for a new one
+        existing_path = self._offer_existing_script(description)
+        if existing_path:
+            return f"Using existing script: {existing_path}\nYou can run it with: {existing_path}"
+
         prompt = self._generate_prompt("script", description)
-        response = self._call_gemini(prompt)
+        response = self._call_gemini(prompt, "script")
         
         # Extract script content
         script_content = self._extract_shell_script(response)
@@ -541,9 +1874,10 @@ Make sure your answer is specifically tailored to this system: {self.system_info
         save_confirmation = input("> ").strip().lower()
         
         if save_confirmation in ("yes", "y"):
-            success, result = self._save_script(script_content, description)
+            success, result, note = self._save_script(script_content, description)
             if success:
-                return f"Script saved to: {result}\nYou can run it with: {result}"
+                message = f"Script saved to: {result}\nYou can run it with: {result}"
+                return f"{message}\n{note}" if note else message
             else:
                 return f"Failed to save script: {result}\n\nScript content:\n{script_content}"
         
@@ -552,13 +1886,13 @@ Make sure your answer is specifically tailored to this system: {self.system_info
     def analyze_error(self, error_log: str) -> str:
         """Analyze an error log and suggest fixes."""
         prompt = self._generate_prompt("errorlog", error_log)
-        return self._call_gemini(prompt)
+        return self._call_gemini(prompt, "errorlog")
     
     def fix_issue(self, problem: str) -> str:
         """Generate and execute commands to fix an issue."""
         # Generate commands to fix the issue
         prompt = self._generate_prompt("fix", problem)
-        response = self._call_gemini(prompt)
+        response = self._call_gemini(prompt, "fix")
         
         # Extract commands (each line that isn't a comment)
         commands = []
@@ -613,10 +1947,57 @@ Make sure your answer is specifically tailored to this system: {self.system_info
         
         return result_str
     
+    def watch_logs(self, paths: List[str]) -> None:
+        """Watch log files and analyze new bursts of errors as they appear."""
+        watcher = LogWatcher(
+            paths,
+            self.config.get('watch_checkpoint_path', "~/.terminal_assistant_watch.json"),
+            debounce=self.config.get('watch_debounce', 2.0),
+            max_burst_seconds=self.config.get('watch_max_burst_seconds', 30.0),
+            signature_ttl_hours=self.config.get('watch_signature_ttl_hours', 24.0),
+        )
+        poll_interval = self.config.get('watch_poll_interval', 1.0)
+        notifier = FileChangeNotifier([os.path.dirname(p) for p in watcher.paths if os.path.isdir(os.path.dirname(p))])
+
+        mode = "inotify" if notifier.using_inotify else f"polling every {poll_interval}s"
+        print(f"Watching {', '.join(watcher.paths)} ({mode}). Press Ctrl+C to stop.")
+
+        last_checkpoint = time.monotonic()
+        try:
+            watcher.add_lines(watcher.read_new_lines(resume=True))
+            while True:
+                flush_in = watcher.time_until_flush()
+                notifier.wait(poll_interval if flush_in is None else min(poll_interval, flush_in))
+                watcher.add_lines(watcher.read_new_lines())
+
+                flush_in = watcher.time_until_flush()
+                if flush_in is not None and flush_in <= 0:
+                    report, signatures, skipped = watcher.take_burst()
+                    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    if skipped:
+                        print(f"[{timestamp}] Skipped {skipped} error line(s) with already analyzed signatures.")
+                    if report:
+                        print(f"[{timestamp}] Analyzing {len(signatures)} new error signature(s)...")
+                        response = self.analyze_error(report)
+                        print("\n" + response + "\n")
+                        if not self.last_call_failed:
+                            watcher.mark_analyzed(signatures)
+                    watcher.save_checkpoint()
+                    last_checkpoint = time.monotonic()
+                elif time.monotonic() - last_checkpoint >= 5:
+                    watcher.save_checkpoint()
+                    last_checkpoint = time.monotonic()
+        except KeyboardInterrupt:
+            print("\nStopping log watch...")
+        finally:
+            watcher.save_checkpoint()
+            watcher.close()
+            notifier.close()
+
     def chat(self, question: str) -> str:
         """Answer a general question about the system."""
         prompt = self._generate_prompt("chat", question)
-        return self._call_gemini(prompt)
+        return self._call_gemini(prompt, "chat")
     
     def run_with_confirmation(self, command: str) -> str:
         """Run a command after user confirmation."""
@@ -665,7 +2046,11 @@ Make sure your answer is specifically tailored to this system: {self.system_info
         elif user_input.startswith("script:"):
             description = user_input[len("script:"):].strip()
             return self.generate_script(description)
-        
+
+        elif user_input.startswith("script-search:"):
+            query = user_input[len("script-search:"):].strip()
+            return self.search_scripts(query)
+
         elif user_input.startswith("errorlog:"):
             error_log = user_input[len("errorlog:"):].strip()
             return self.analyze_error(error_log)
@@ -684,10 +2069,15 @@ Make sure your answer is specifically tailored to this system: {self.system_info
                 'safety_level': self.safety_level,
                 'auto_confirm_safe': self.auto_confirm_safe,
                 'scripts_dir': self.scripts_dir,
+                'command_cache': self.command_cache is not None,
+                'live_snapshot': self.live_snapshot_enabled,
                 'model': self.config.get('model', 'gemini-pro')
             }
             return json.dumps(info, indent=2)
             
+        elif user_input.strip() == "snapshot":
+            return self.live_snapshot()
+            
         elif user_input.startswith("safety-level:"):
             level = user_input[len("safety-level:"):].strip()
             return self.set_safety_level(level)
@@ -708,11 +2098,12 @@ def main():
     parser.add_argument("--config", help=f"Path to config file (default: {DEFAULT_CONFIG_PATH})")
     parser.add_argument("--scripts-dir", help="Directory to save generated scripts")
     parser.add_argument("--auto-confirm-safe", action="store_true", help="Auto-confirm non-critical commands")
+    parser.add_argument("--watch", nargs="+", metavar="PATH", help="Watch log files and analyze new error bursts")
     parser.add_argument("--version", action="version", version=f"Terminal Assistant v{VERSION}")
     
     args = parser.parse_args()
     
-    if MISSING_DEPENDENCIES and args.query:
+    if MISSING_DEPENDENCIES and (args.query or args.watch):
         print("Cannot process query due to missing dependencies.")
         check_dependencies()
         sys.exit(1)
@@ -726,10 +2117,13 @@ def main():
     
     assistant = TerminalAssistant(api_key=args.api_key, config_path=args.config)
     
-    if args.interactive:
+    if args.watch:
+        assistant.watch_logs(args.watch)
+    
+    elif args.interactive:
         print(f"Terminal Assistant v{VERSION} (powered by Gemini AI)")
         print("Type 'exit' or 'quit' to exit")
-        print("Commands: explain:, install:, auto-install:, script:, errorlog:, fix:, exec:, system-info, safety-level:")
+        print("Commands: explain:, install:, auto-install:, script:, script-search:, errorlog:, fix:, exec:, system-info, snapshot, safety-level:")
         print("Or just ask any question about your system.")
         print()
         
@@ -0,0 +1,103 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from terminal_assistant import LogWatcher
+
+
+class LogWatcherTest(unittest.TestCase):
+    """Tests for incremental log tailing, rotation and checkpoint resume."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log_path = os.path.join(self.tmp.name, "app.log")
+        self.checkpoint_path = os.path.join(self.tmp.name, "checkpoint.json")
+        with open(self.log_path, 'w') as f:
+            f.write("existing line\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _watcher(self):
+        return LogWatcher([self.log_path], self.checkpoint_path)
+
+    def _append(self, text):
+        with open(self.log_path, 'a') as f:
+            f.write(text)
+
+    def test_starts_at_end_of_existing_file(self):
+        watcher = self._watcher()
+        self.assertEqual(watcher.read_new_lines(resume=True), [])
+        self._append("error: new\n")
+        self.assertEqual(watcher.read_new_lines(), [(self.log_path, "error: new")])
+        watcher.close()
+
+    def test_rotation_reads_rest_of_old_file(self):
+        watcher = self._watcher()
+        watcher.read_new_lines(resume=True)
+
+        # More than one read's worth of data, ending in an unterminated line
+        filler = ("x" * 1023 + "\n") * (LogWatcher.MAX_READ_BYTES // 1024 + 200)
+        self._append(filler + "error: LAST LINE OF OLD FILE")
+        os.rename(self.log_path, self.log_path + ".1")
+        with open(self.log_path, 'w') as f:
+            f.write("error: first line of new file\n")
+
+        lines = []
+        for _ in range(5):
+            lines.extend(line for _, line in watcher.read_new_lines())
+        watcher.close()
+
+        self.assertIn("error: LAST LINE OF OLD FILE", lines)
+        self.assertEqual(lines[-1], "error: first line of new file")
+        self.assertTrue(all(line == "x" * 1023 for line in lines[:-2]))
+
+    def test_checkpoint_resume_rereads_partial_line(self):
+        watcher = self._watcher()
+        watcher.read_new_lines(resume=True)
+        self._append("error: complete\nerror: unterminated")
+        self.assertEqual(watcher.read_new_lines(), [(self.log_path, "error: complete")])
+        watcher.save_checkpoint()
+        watcher.close()
+
+        self._append(" now finished\nerror: after restart\n")
+        resumed = self._watcher()
+        self.assertEqual(
+            [line for _, line in resumed.read_new_lines(resume=True)],
+            ["error: unterminated now finished", "error: after restart"],
+        )
+        resumed.close()
+
+    def test_analyzed_signatures_survive_restart(self):
+        watcher = self._watcher()
+        watcher.read_new_lines(resume=True)
+        self._append("Oct 18 10:00:01 host app[12]: ERROR timeout after 30s\n")
+        watcher.add_lines(watcher.read_new_lines())
+        report, signatures, skipped = watcher.take_burst()
+        self.assertTrue(report)
+        watcher.mark_analyzed(signatures)
+        watcher.save_checkpoint()
+        watcher.close()
+
+        resumed = self._watcher()
+        resumed.read_new_lines(resume=True)
+        self._append("Oct 18 10:05:42 host app[97]: ERROR timeout after 31s\n")
+        resumed.add_lines(resumed.read_new_lines())
+        report, signatures, skipped = resumed.take_burst()
+        resumed.close()
+        self.assertEqual((report, signatures, skipped), ("", [], 1))
+
+    def test_unreadable_path_is_skipped(self):
+        watcher = LogWatcher([self.tmp.name, self.log_path], self.checkpoint_path)
+        watcher.read_new_lines(resume=True)
+        self._append("error: still watched\n")
+        self.assertEqual(watcher.read_new_lines(), [(self.log_path, "error: still watched")])
+        self.assertIn(os.path.abspath(self.tmp.name), watcher.unreadable)
+        watcher.close()
+
+
+if __name__ == "__main__":
+    unittest.main()